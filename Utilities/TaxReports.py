@@ -1,15 +1,35 @@
 import io
 import logging
 from calendar import month_name, monthrange
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple
 
+import numpy as np
 import openpyxl as xl
 import pandas as pd
+from openpyxl.cell import WriteOnlyCell
 
 from Utilities.config import full_account_names
 from Utilities.report_tools import ReportDownloadOrchestrator
-from Utilities.utils import BlobHandler, DateRanges, DateRangeOption, Style, states
+from Utilities.utils import BlobHandler, DateRanges, DateRangeOption, states
+
+# full state names (e.g. 'NEW YORK') in report order, built once - the single source for every states lookup below
+_REPORT_STATES = tuple(dict.fromkeys(states.values()))  # de-duplicated, in case several keys map to one name
+_STATE_NAMES = frozenset(_REPORT_STATES)  # O(1) membership checks when binning ship-states
+_STATE_TITLES = [state.title() for state in _REPORT_STATES]
+
+# pivot bins follow the report order, with a trailing 'OTHER' bin unless `states` already reports it
+_STATE_CATEGORIES = _REPORT_STATES if 'OTHER' in _STATE_NAMES else (*_REPORT_STATES, 'OTHER')
+
+# max 31D orders reports in flight at once (report creation itself is throttled to SP-API's createReport quota, 
+# a burst of 15 then ~1/min, by the `RateLimiter` that every orchestrator fork shares)
+_MAX_CONCURRENT_REPORTS = 4
+
+# report styles, built once and shared by every cell that uses them
+_CENTER = xl.styles.Alignment(horizontal='center', vertical='center')
+_BOLD = xl.styles.Font(bold=True)
+_HIGHLIGHT = xl.styles.PatternFill(start_color='DDEBF7', end_color='DDEBF7', fill_type='solid')
+_CURRENCY_FORMAT = '$#,##0.00'
 
 
 class TaxRevenueReportGenerator:
@@ -27,9 +47,13 @@ class TaxRevenueReportGenerator:
         -Eager-loads the `ReportDownloadOrchestrator` and `GenerateFBAReport` classes - will raise error if your 
          Azure account, key vault, storage account, and environment variables are missing or not configured
     """
+    # zero-sales pivot table, built once (see Utils.states dict for reference) - copied out on each use
+    _NO_SALES_TEMPLATE = pd.DataFrame({'States': [*_REPORT_STATES, 'Total'], 'Revenue': 0, 'Tax': 0})
+
     def __init__(self, account_name: str, start_date: str, end_date: str):
         # validate date query params
         self.date_ranges = DateRanges()
+        self.default_dates_used = False  # set before validating, `_validate_date_inputs` flips it if defaults are used
         self.start_date = start_date
         self.end_date = end_date
         self.start_date, self.end_date = self._validate_date_inputs(self.start_date, self.end_date)
@@ -42,7 +66,6 @@ class TaxRevenueReportGenerator:
         self.account_name_full = self._set_account_name_full()  # relies on config.full_account_names dict
         
         # class utils
-        self.default_dates_used = False
         self.date_name = None
         self.df = None
         self.report_name = None
@@ -73,6 +96,10 @@ class TaxRevenueReportGenerator:
                 )
             start_date, end_date = self.date_ranges.set_default_date_range(default_to=DateRangeOption.PREVIOUS_MONTH)
             self.default_dates_used = True
+
+            # default dates are already formatted as '%m-%d-%Y', no need to validate/clean them
+            logging.info(f"Using default date range: {start_date} - {end_date}")
+            return start_date, end_date
                     
         # basic validation of date params        
         self.date_ranges.validate_date_logic(start_date=start_date, end_date=end_date)
@@ -86,11 +113,13 @@ class TaxRevenueReportGenerator:
     @staticmethod
     def _no_sales_pivot_table_creator() -> pd.DataFrame:
         """Returns a df with columns=['State', 'Revenue', 'Tax'], with each state containing $0 revenue and tax"""
-        state_names = list(states.values())  # see Utils.states dict for reference 
-        no_sales_df = pd.DataFrame(state_names + ['Total'], columns=['States'])
-        no_sales_df = no_sales_df.assign(Revenue=0, Tax=0)
-        return no_sales_df
+        return TaxRevenueReportGenerator._NO_SALES_TEMPLATE.copy()
     
+    @staticmethod
+    def _parse_purchase_dates(purchase_dates: pd.Series) -> pd.Series:
+        """Parses the ISO `purchase-date` column into datetime64 dates (calendar date as printed, offset ignored)"""
+        return pd.to_datetime(purchase_dates.str.slice(0, 10), format='%Y-%m-%d')
+
     def _set_account_name_full(self) -> str:
         """Populates `account_name_full` attribute by pulling the full name from config.full_account_names dict"""
         try: 
@@ -114,15 +143,14 @@ class TaxRevenueReportGenerator:
         """
         # if user left start/end dates blank, default to entire previous month as range
         if self.default_dates_used is True:
-            previous_month = self.date_ranges.last_months_date_range[0].split("-")[0]
-            previous_year = self.date_ranges.last_months_date_range[0].split("-")[-1]
-            self.date_name = f"{month_name[int(previous_month)]} {previous_year}"
+            previous_month = self.date_ranges.str_to_date(self.date_ranges.last_months_date_range[0])
+            self.date_name = f"{month_name[previous_month.month]} {previous_month.year}"
             
         # if user provided date parameters...
         else:
             # if start_date and end_date equate to an entire month, return monthname_year
-            start_date_input = datetime.strptime(self.start_date, '%m-%d-%Y')
-            end_date_input = datetime.strptime(self.end_date, '%m-%d-%Y')
+            start_date_input = self.date_ranges.str_to_date(self.start_date)
+            end_date_input = self.date_ranges.str_to_date(self.end_date)
             first_date_of_that_month = start_date_input.replace(day=1)
             last_day_of_that_month = monthrange(start_date_input.year, start_date_input.month)[1]
             last_date_of_that_month = start_date_input.replace(day=last_day_of_that_month) 
@@ -141,7 +169,13 @@ class TaxRevenueReportGenerator:
         
         return self.date_name
     
-    def get_orders_data(self, start_date: str, end_date: str, max_retries: int = 10) -> str:
+    def get_orders_data(
+        self, 
+        start_date: str, 
+        end_date: str, 
+        max_retries: int = 10, 
+        max_wait_seconds: float = 6300
+    ) -> pd.DataFrame:
         """
         Requests/downloads FBA orders data from the 'Reports' SP-API for the date range specified 
 
@@ -149,9 +183,10 @@ class TaxRevenueReportGenerator:
             -`start_date` (str): The start date of the range you wish to generate orders for (format="%m-%d-%Y")
             -`end_date` (str): The end date of the range you wish to generate orders for (format="%m-%d-%Y")
             -`max_retries` (int): n times to check status with exponential backup before passing a failure (default=10)
+            -`max_wait_seconds` (float): how long to wait on SP-API to finish building the report (default=6300)
 
         Returns:
-            -(str): Tabular orders data, saved as json str (also updates `df` instance attribute)\n       
+            -(pd.DataFrame): Tabular orders data (also updates `df` instance attribute)\n       
             -Updates the `start_date`, `end_date`, `default_dates_used` and `df` instance attributes
 
         Considerations:
@@ -160,12 +195,27 @@ class TaxRevenueReportGenerator:
             -The API can only generate up to 31 days per request. Thus, for longer ranges, it will take some time
              to complete             
         """                        
+        self.df = self._fetch_orders_data(self.orchestrator, start_date, end_date, max_retries, max_wait_seconds)
+        return self.df
+
+    @staticmethod
+    def _fetch_orders_data(
+        orchestrator: ReportDownloadOrchestrator, 
+        start_date: str, 
+        end_date: str, 
+        max_retries: int,
+        max_wait_seconds: float
+    ) -> pd.DataFrame:
+        """Requests/downloads the orders data via `orchestrator` - touches no instance state, safe to run in threads"""
+        # 'get_report' serializes to json by default (for durable functions) - same process here, so take the df as-is
         try:
-            order_data_json = self.orchestrator.get_report(
+            return orchestrator.get_report(
                 report_type='GET_FLAT_FILE_ALL_ORDERS_DATA_BY_ORDER_DATE_GENERAL',
                 start_date=start_date,
                 end_date=end_date,
-                max_retries=max_retries
+                max_retries=max_retries,
+                as_json=False,
+                max_wait_seconds=max_wait_seconds
                 )
             
         # adding generic except-block just for the log - underlying 'get_report' method handles all errors/retries  
@@ -173,15 +223,6 @@ class TaxRevenueReportGenerator:
             logging.error(f"Could not generate order data for dates {start_date} - {end_date}: {str(e)}")
             raise
         
-        # 'get_report' method returns tabular data in json, must convert back into Pandas df
-        try:
-            self.df = pd.read_json(io.StringIO(order_data_json))
-            return self.df
-        
-        except Exception as e:
-            logging.info("Failure in 'get_orders_data' method - could not parse json data into pd.df")
-            raise RuntimeError(f"Could not parse orders data json to Pandas DataFrame: {str(e)}")
-        
     def tax_report_compiler(self, df: pd.DataFrame) -> pd.DataFrame:
         """Generates a pivot-table pd.df out of the `GET_FLAT_FILE_ALL_ORDERS_DATA_BY_ORDER_DATE_GENERAL` report
         
@@ -230,65 +271,70 @@ class TaxRevenueReportGenerator:
             if column not in df.columns:
                 raise KeyError(f"Could not locate required column '{column}' in your DataFrame")
                 
-        # format iso column to date object
-        df['purchase-date-formatted'] = pd.to_datetime(df['purchase-date'].str.split("T").str[0]).dt.date        
-
         # set new start/end dates (must set start/end dates to None to infer dates from the orders data) 
         if self.start_date is None and self.end_date is None:
-            self.start_date = df['purchase-date-formatted'].min().strftime("%m-%d-%Y")
-            self.end_date = df['purchase-date-formatted'].max().strftime("%m-%d-%Y")
+            order_dates = self._parse_purchase_dates(df['purchase-date'])
+            self.start_date = order_dates.min().strftime("%m-%d-%Y")
+            self.end_date = order_dates.max().strftime("%m-%d-%Y")
             self.default_dates_used = False
         
-        # convert the date attributes back to date obj, in order to be able to compare with df dates 
-        start_date_input = datetime.strptime(self.start_date, "%m-%d-%Y").date()
-        end_date_input = datetime.strptime(self.end_date, "%m-%d-%Y").date()
-        
-        # apply filters (drop duplicates, US purchases only, no cancelled orders, no removal orders, date filter)
-        df = df.drop_duplicates() \
-            .loc[
-                lambda x:
-                    (x['ship-country'] == 'US') &
-                    (x['item-status'] != 'Cancelled') &
-                    (x['product-name'] != '-') & 
-                    (x['purchase-date-formatted'] >= start_date_input) & 
-                    (x['purchase-date-formatted'] <= end_date_input)
-                ]  # a few out-of-range dates always make it through in these reports, need to filter them out
+        # convert the date attributes to timestamps, in order to be able to compare with df dates 
+        start_date_input = pd.Timestamp(self.date_ranges.str_to_date(self.start_date))
+        end_date_input = pd.Timestamp(self.date_ranges.str_to_date(self.end_date))
+        
+        # apply filters (US purchases only, no cancelled orders, no removal orders) first, so that the date parsing 
+        # below only runs on the rows that can make it into the report
+        df = df.loc[np.logical_and.reduce([
+            df['ship-country'].to_numpy() == 'US',
+            df['item-status'].to_numpy() != 'Cancelled',
+            df['product-name'].to_numpy() != '-'
+        ])]
+
+        # date filter (a few out-of-range dates always make it through in these reports, need to filter them out), 
+        # then drop duplicates - the 31-day API chunks may overlap, filtering first means only kept rows get hashed
+        purchase_dates = self._parse_purchase_dates(df['purchase-date']).to_numpy()
+        df = df.loc[
+            (purchase_dates >= start_date_input.to_datetime64()) & 
+            (purchase_dates <= end_date_input.to_datetime64())
+            ] \
+            .drop_duplicates()
+
+        # one typed conversion up-front - keeps the sums below on float64 whatever dtype the source data came in as
+        # (NaN amounts count as $0, both for the zero-sales check and the pivot)
+        item_price = np.nan_to_num(df['item-price'].to_numpy(dtype='float64'))
+        item_tax = np.nan_to_num(df['item-tax'].to_numpy(dtype='float64'))
 
         # if df is not empty yet the data doesn't contain anything meaningful, return the no sales pivot table
         # note: this line must go after the date checks above, else it will terminate before setting the new 
         # start/end date attributes, and the date portion of the report name wont populate correctly
-        if df['item-price'].sum() == 0 and df['item-tax'].sum() == 0:
+        if item_price.sum() == 0 and item_tax.sum() == 0:
             return self._no_sales_pivot_table_creator()
 
-        # clean states data and normalize the names using Utilities.utils.states
-        df = df.assign(ship_state_FIXED = df['ship-state'].str.upper().str.replace(".", "").replace(states))
+        # clean states data and normalize the names using Utilities.utils.states (abbreviations -> full names)
+        # (cast to str dtype first - a ship-state column that is entirely blank is read in as float NaNs; arrow-backed, 
+        # so the upper/replace below run on pyarrow's utf8 compute kernels)
+        ship_states = df['ship-state'].astype('string[pyarrow]').str.upper().str.replace(".", "", regex=False)
+        ship_states = ship_states.map(states).fillna(ship_states)
 
         # map any non-state US locations (overseas territories, army bases) into an "OTHER" bin
-        df['ship_state_FIXED'] = df['ship_state_FIXED'].map(lambda x: 'OTHER' if x not in states.values() else x)
-
-        # pivot by revenue/tax
-        df_pivot = df.groupby('ship_state_FIXED').agg({'item-price': 'sum', 'item-tax': 'sum'})
-
-        # join back to the states dictionary (need full list of all states, even if they have 0 sales)
-        states_df = pd.DataFrame(states.values()).rename(columns={0:'ship_state_FIXED'})
-        final_df = pd.merge(states_df, df_pivot, on='ship_state_FIXED', how='left').fillna(0)
-
-        # final clean
-        final_df.rename(
-            columns={'ship_state_FIXED': 'States', 'item-price': 'Revenue', 'item-tax': 'Tax'}, 
-            inplace=True
-        )
-        final_df['States'] = final_df['States'].str.title()
-
-        # create a 'Total' row, append to the bottom of main df
-        totals_row = pd.DataFrame({
-            'States': 'Total', 
-            'Revenue': final_df['Revenue'].sum(), 
-            'Tax': final_df['Tax'].sum()
-            },
-            index=[0]
-        )
-        final_df = pd.concat([final_df, totals_row], ignore_index=True)
+        state_codes = pd.Categorical(
+            ship_states.where(ship_states.isin(_STATE_NAMES), 'OTHER'), 
+            categories=_STATE_CATEGORIES
+            ).codes
+
+        # pivot by revenue/tax - a weighted bincount sums each state in one pass over the codes, and returns every 
+        # state even if it had 0 sales (unreported 'OTHER' bin is dropped, rounded to cents)
+        n_bins = len(_REPORT_STATES) + 1
+        revenue = np.bincount(state_codes, weights=item_price, minlength=n_bins)
+        tax = np.bincount(state_codes, weights=item_tax, minlength=n_bins)
+        revenue, tax = revenue[:len(_REPORT_STATES)].round(2), tax[:len(_REPORT_STATES)].round(2)
+
+        # assemble the final df, with a 'Total' row at the bottom
+        final_df = pd.DataFrame({
+            'States': _STATE_TITLES + ['Total'],
+            'Revenue': np.append(revenue, revenue.sum()),
+            'Tax': np.append(tax, tax.sum())
+        })
         
         return final_df
 
@@ -314,50 +360,49 @@ class TaxRevenueReportGenerator:
                     f"Make sure you ran the 'tax_report_compiler' first"
                     )
                 
-        # load wb, styler pen
-        wb = xl.Workbook()
-        ws = wb.active
-        styler = Style(ws)
+        # write-only workbook streams rows straight to xml instead of holding every cell object in memory
+        wb = xl.Workbook(write_only=True)
+        ws = wb.create_sheet()
 
         # this is required to format cell 'B3', but may be populated already if ran 'set_tax_report_name' already    
         if self.date_name is None:
             self._set_date_name()
         
-        # build report headers
-        ws['A1'] = 'Account'
-        ws['A2'] = 'Report'
-        ws['A3'] = 'Month'
-        ws['A4'] = ''
-        ws['B1'] = self.account_name_full
-        ws['B2'] = 'Revenue/Tax breakdown by state'
-        ws['B3'] = self.date_name
-        [ws.merge_cells(cells) for cells in ['B1:C1', 'B2:C2', 'B3:C3']]  # merge top cells
-
-        # add df headers into ws (e.g. States, Revenue and Tax)
-        for index, row in enumerate(df.columns, 1):
-            ws.cell(row=5, column=index, value=row)
-
-        # add df contents into ws
-        for index, row in enumerate(df.values, 6):
+        # assemble rows up-front: report headers, blank spacer, df headers (e.g. States, Revenue and Tax), df contents
+        rows = [
+            ['Account', self.account_name_full, None],
+            ['Report', 'Revenue/Tax breakdown by state', None],
+            ['Month', self.date_name, None],
+            ['', None, None],
+            list(df.columns),
+            *df.itertuples(index=False, name=None)
+        ]
+        last_row = len(rows)  # the 'Total' row
+
+        # write-only sheets can't be edited once rows are written, so column widths/merges/filters are set first
+        for col_index, values in enumerate(zip(*rows), 1):
+            max_length = max(len(str(value)) for value in values if value is not None)
+            ws.column_dimensions[xl.utils.get_column_letter(col_index)].width = max_length + 4
+        for cells in ('B1:C1', 'B2:C2', 'B3:C3'):
+            ws.merged_cells.add(cells)  # merge top cells
+        ws.auto_filter.ref = f'A5:C{last_row}'  # add filter for headers
+
+        # add rows into ws, styling each cell as it is written (center/align everything, headers & totals are 
+        # bold/highlighted, Revenue/Tax cols are formatted as currency)
+        for row_index, row in enumerate(rows, 1):
+            cells = []
             for col_index, value in enumerate(row, 1):
-                ws.cell(row=index, column=col_index, value=value)
-
-        # formatting Revenue/Tax cols as currency
-        [styler.currency_formatter(columns=col, min_row=6, currency=True) for col in ['B', 'C']]
-
-        # center/align everything
-        styler.align_and_center(padding=4)
-
-        # make necessary cells bold
-        cells_to_bold = ['A1', 'A2', 'A3', 'A5', 'B5', 'C5', f'A{ws.max_row}', f'B{ws.max_row}', f'C{ws.max_row}']
-        [styler.apply_styles_to_cell(cell, bold=True, highlighter=False) for cell in cells_to_bold]
-
-        # highlight necessary cells
-        cells_to_color = ['A5', 'B5', 'C5', f'A{ws.max_row}', f'B{ws.max_row}', f'C{ws.max_row}']
-        [styler.apply_styles_to_cell(cell, bold=False, highlighter=True, color='DDEBF7') for cell in cells_to_color]
-
-        # add filter for headers
-        ws.auto_filter.ref = f'A5:C{ws.max_row}'
+                cell = WriteOnlyCell(ws, value=value)
+                cell.alignment = _CENTER
+                if row_index in (5, last_row):
+                    cell.font = _BOLD
+                    cell.fill = _HIGHLIGHT
+                elif row_index <= 3 and col_index == 1:
+                    cell.font = _BOLD
+                if row_index > 5 and col_index in (2, 3):
+                    cell.number_format = _CURRENCY_FORMAT
+                cells.append(cell)
+            ws.append(cells)
 
         # save to buffer
         output_buffer = io.BytesIO()
@@ -386,7 +431,13 @@ class TaxRevenueReportGenerator:
         self.report_name = f"{self.account_name_full} - Revenue Tax Breakdown - {self.date_name}"
         return self.report_name
     
-    def generate_tax_report(self, storage_account: str, container_name: str, max_retries: int = 10) -> None:
+    def generate_tax_report(
+        self, 
+        storage_account: str, 
+        container_name: str, 
+        max_retries: int = 10, 
+        max_wait_seconds: float = 6300
+    ) -> None:
         """
         Orchestrates the entire tax report automation workflow:\n
             Requests FBA orders data from SP-API for the date range passed to the class instance\n
@@ -399,9 +450,14 @@ class TaxRevenueReportGenerator:
             -`storage_account` (str): The name of your Azure storage account
             -`container_name` (str): The name of the blob container in your storage account
             -`max_retries` (int): n times to check status with exp. backup before passing a failure (Default=10)
+            -`max_wait_seconds` (float): how long to wait on SP-API to finish building each report (Default=6300)
         
         Considerations:
-            -Orders data is requested in 31 day chunks. For longer date-ranges, job will take a while to complete
+            -Orders data is requested in 31 day chunks, up to 4 at a time. For longer date-ranges, job will take a 
+            while to complete
+            
+            -If any chunk fails, raises right away and cancels the queued ones. Chunks already in flight are not 
+            interrupted, they keep polling SP-API in the background until they finish or time out
         """
         # instantiate a blob client
         if self.blobclient is None:
@@ -411,30 +467,43 @@ class TaxRevenueReportGenerator:
                 logging.error(f"Could not start blob client: {str(e)}")
                 raise
         
-        # iterate through date ranges list and generate orders data in 31D blocks, then concat to one final df 
+        # generate orders data in 31D blocks concurrently (each block spends most of its time waiting on SP-API to 
+        # build the report), each worker on its own fork of the orchestrator so report ids/urls don't collide
         df = []
-        min_max_dates = []  # get the first and last dates in here to be able to name the report properly
-        n_ranges = len(self.report_ranges) 
-        for index, date_range in enumerate(self.report_ranges):
-            try:
-                start_date, end_date = date_range
-                if index == 0:
-                    min_max_dates.append(start_date)
-                if index == n_ranges-1:
-                    min_max_dates.append(end_date)
-
-                _df = self.get_orders_data(start_date=start_date, end_date=end_date, max_retries=max_retries)
-                df.append(_df)                
+        n_workers = min(len(self.report_ranges), _MAX_CONCURRENT_REPORTS)
+        # no `with` block - its __exit__ waits on every chunk, so a failure would only surface once all had finished
+        executor = ThreadPoolExecutor(max_workers=n_workers)
+        try:
+            futures = [
+                executor.submit(
+                    self._fetch_orders_data, 
+                    self.orchestrator.fork(), 
+                    start_date, 
+                    end_date, 
+                    max_retries, 
+                    max_wait_seconds
+                    )
+                for start_date, end_date in self.report_ranges
+                ]
             
-                logging.info(f"Retrieved orders data for '{self.account_name}' for {start_date} - {end_date}")
+            # collect in date order, so the concat below is the same as it would be if requested one at a time
+            for future, (start_date, end_date) in zip(futures, self.report_ranges):
+                try:
+                    df.append(future.result())
+                    logging.info(f"Retrieved orders data for '{self.account_name}' for {start_date} - {end_date}")
             
-            except Exception as e:
-                logging.error(f"Failed getting orders data from SP-API for {start_date} - {end_date}: {str(e)}")
-                raise         
+                except Exception as e:
+                    logging.error(f"Failed getting orders data from SP-API for {start_date} - {end_date}: {str(e)}")
+                    raise
+        
+        finally:
+            # queued chunks are cancelled, ones already running finish in the background (results discarded)
+            executor.shutdown(wait=False, cancel_futures=True)
         
-        # convert list of dfs into one df
+        # convert list of dfs into one df (dates may overlap, 'tax_report_compiler' drops any doubles)
         try:                  
-            df = pd.concat(df, ignore_index=True).drop_duplicates()  # dates may overlap, drop any doubles
+            df = pd.concat(df, ignore_index=True)
+            self.df = df
         except Exception as e:
             logging.error(f"Could not concatenate dfs: {str(e)}")
             
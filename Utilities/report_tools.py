@@ -1,11 +1,14 @@
 from ast import literal_eval
+import copy
 from datetime import datetime, timedelta
 import gzip
 import io
 import json
 import logging
 import os
+import random
 import re
+import time
 from typing import Optional, Tuple, Union
 
 from azure.identity import DefaultAzureCredential
@@ -17,7 +20,7 @@ import pandas as pd
 import pytz
 import requests as req
 
-from Utilities.utils import Helpers, Style, ZeroSalesError
+from Utilities.utils import Helpers, RateLimiter, Style, ZeroSalesError
 
 
 class GenerateFBAReport:
@@ -102,6 +105,9 @@ class GenerateFBAReport:
         self.report_type = None 
         self.download_url = None
         self.compression = None
+        
+        # createReport quota (1 request/min, burst of 15) - shared by every fork, so concurrent requests respect it
+        self.create_report_limiter = RateLimiter(rate=.0167, burst=15)
     
     def __validate_environment_variables(self) -> None:
         """Private method: validates the Function App environmental variables upon class instantiation"""
@@ -402,6 +408,7 @@ class GenerateFBAReport:
         while current_attempt <= max_attempts:
             try:                
                 report_endpoint = self.reports_url + '/reports' 
+                self.create_report_limiter.acquire()
                 request_download = req.post(
                     url=report_endpoint,
                     headers={'x-amz-access-token': self.access_token},
@@ -419,6 +426,12 @@ class GenerateFBAReport:
                         f"{request_download.status_code} Error for report ID {self.report_id}"
                         )
 
+                # quota exceeded - createReport refills at ~1 request/min, a short backoff would just burn attempts
+                elif request_download.status_code == 429:
+                    logging.warning(f"Quota exceeded requesting '{self.report_type}', waiting for it to refill")
+                    Helpers.exponential_backoff(n=current_attempt, rate_of_growth=1, base_seconds=60)
+                    current_attempt += 1
+
                 else:
                     logging.error(f"{request_download.status_code} Error for report ID {self.report_id}")
                     Helpers.exponential_backoff(n=current_attempt, rate_of_growth=1.75, base_seconds=4)
@@ -722,13 +735,26 @@ class GenerateFBAReport:
                 with gzip.GzipFile(fileobj=buffer) as gz:
                     report_contents = gz.read().decode('latin1')
                 
-            df = pd.read_csv(io.StringIO(report_contents), sep='\t', encoding='latin1', low_memory=False)
+            df = self._report_contents_to_df(report_contents)
             return df       
 
         except Exception as e:
             logging.error(f"Downloaded report from {current_download_url} but could not process to df: {str(e)}")
             raise    
+
+    @staticmethod
+    def _report_contents_to_df(report_contents: str) -> pd.DataFrame:
+        """
+        Parses the tab-delimited report contents into a Pandas DataFrame
+        
+        Considerations:
+            -Uses the multithreaded pyarrow parser, via `Helpers.read_delimited`
             
+            -Date columns are kept as raw ISO strings (pyarrow would otherwise infer them as timestamps, and the 
+            downstream report methods expect str dates)
+        """
+        return Helpers.read_delimited(report_contents.encode('utf-8'), delimiter='\t')
+
 
 class ReportAssembler:
     """Compiles and styles/formats DataFrames and IO objects, into .xlsx files/reports
@@ -923,14 +949,12 @@ class ReportAssembler:
             styler.align_and_center()
             styler.create_table()
             
-            # format certain cells with bold/highlight (confusing to read, refer to utils.py, sorry)
-            cells_to_fmt = {'A2': [True, False], 'C2': [True, True], 'D2': [True, True]}
-            for cell, fmt in cells_to_fmt.items():
-                styler.apply_styles_to_cell(cell=cell, bold=fmt[0], highlighter=fmt[1])
+            # format certain cells with bold/highlight (grand totals row)
+            styler.apply_styles_to_cell(cell='A2', bold=True, highlighter=False)
+            styler.apply_styles_to_cell(cell=['C2', 'D2'], bold=True, highlighter=True)
 
             # change header text color to white, make it more legible
-            for cell in ['A1', 'B1', 'C1', 'D1', 'E1']:
-                styler.change_font_color(cell, "FFFFFFFF")
+            styler.change_font_color(['A1', 'B1', 'C1', 'D1', 'E1'], "FFFFFFFF")
 
             # add currency and/or thousands separator to certain columns
             numeric_cols_fmt = {'C': False, 'E': False, 'D': True}
@@ -1074,8 +1098,7 @@ class ReportAssembler:
         pen.create_table(table_name=table_name)
         
         # change header text to white 
-        for cell in ['A1', 'B1', 'C1', 'D1', 'E1']:
-            pen.change_font_color(cell=cell, color="FFFFFFFF")
+        pen.change_font_color(cell=['A1', 'B1', 'C1', 'D1', 'E1'], color="FFFFFFFF")
 
         # add data bars         
         for col in ['D', 'E']:
@@ -1129,7 +1152,27 @@ class ReportDownloadOrchestrator:
         # get access token once, so you needn't request it each time
         self.GenerateFBAReport.request_access_token()
     
-    def get_report(self, report_type: str, start_date: str, end_date: str, max_retries: int = 10) -> str:
+    def fork(self) -> 'ReportDownloadOrchestrator':
+        """
+        Returns a copy of the orchestrator that shares the API keys/access token, but tracks its own report state
+        
+        Considerations:
+            -`GenerateFBAReport` keeps the current report id, download url etc. as instance attributes, so concurrent 
+            `get_report` calls must each run on their own fork (no extra key vault or token requests are made)
+        """
+        forked = copy.copy(self)
+        forked.GenerateFBAReport = copy.copy(self.GenerateFBAReport)
+        return forked
+
+    def get_report(
+        self, 
+        report_type: str, 
+        start_date: str, 
+        end_date: str, 
+        max_retries: int = 30, 
+        as_json: bool = True,
+        max_wait_seconds: float = 6300
+    ) -> Union[str, pd.DataFrame]:
         """
         Requests orders by date range from Amazon SP-API (Requests, waits until ready, and downloads)
         
@@ -1137,17 +1180,24 @@ class ReportDownloadOrchestrator:
             -report_type: (str) The name of the SP-API you wish to generate/download
             -start_date: (str) The starting date of the range you wish to run the report for
             -end_date: (str) The ending date of the range you wish to run the report for 
-            -`max_retries` (int): n times to check status with exp. backup before passing a failure (default=10)
+            -`max_retries` (int): n times to retry a failed status check/download before passing a failure 
+            (default=30)
+            -`as_json` (bool): if False, returns the downloaded DataFrame as-is, skipping the json serialization 
+            (default=True)
+            -`max_wait_seconds` (float): how long to keep polling a report that isn't ready yet (default=6300, about 
+            as long as the old 10-attempt exponential schedule waited - large reports can sit in SP-API's queue a while)
         
         Returns:
             -str: report contents in json, so as to be transferable between durable functions
+            -pd.DataFrame: report contents, if `as_json` is False (for callers in the same process)
  
         Considerations:
             -Refer to 'GenerateFBAReport' class docstrings for specificities about possible parameters   
             -You can pass dates to `get_report` method, or use class properties containing some common date-ranges         
+            -Status is polled quickly at first (0.3s, growing 1.25x), then settles at every 5s, so a finished report 
+            is picked up soon after it's ready rather than after a long exponential sleep
         """
-        def __init__(self):
-            self.df = None
+        self.df = None
         
         # request the report using the class input parameters 
         self.GenerateFBAReport.request_FBA_report(
@@ -1156,17 +1206,19 @@ class ReportDownloadOrchestrator:
             end_date=end_date
         )
         
-        # check report status and download once ready 
+        # check report status and download once ready (polls while waiting, retries on errors)
+        poll_count = 0
         current_attempt = 1
         max_attempts = max_retries  # these reports can be tiny/huge - setting higher max_attempts helps to scale
-        while current_attempt <= max_attempts:
+        deadline = time.monotonic() + max_wait_seconds
+        while current_attempt <= max_attempts and time.monotonic() < deadline:
             try:
                 status = self.GenerateFBAReport.check_report_status()
                 
                 if status == 'DONE':
                     self.GenerateFBAReport.get_download_url()
                     df = self.GenerateFBAReport.download_report()
-                    self.df = df.to_json(orient='records')
+                    self.df = df.to_json(orient='records') if as_json else df
                     return self.df
                 
                 elif status in ['FATAL', 'CANCELLED']:
@@ -1181,7 +1233,7 @@ class ReportDownloadOrchestrator:
                         logging.info(f"new report ID is {self.GenerateFBAReport.report_id}")
                         self.GenerateFBAReport.get_download_url()
                         df = self.GenerateFBAReport.download_report()
-                        df = df.to_json(orient='records')
+                        df = df.to_json(orient='records') if as_json else df
                         logging.info("Successfully fetched the backup inventory report")
                         return df                        
 
@@ -1189,16 +1241,28 @@ class ReportDownloadOrchestrator:
                     else:
                         raise RuntimeError(f"Couldn't get orders for {start_date}-{end_date}, {max_attempts} attempts")
                 
+                elif status in ['IN_QUEUE', 'IN_PROGRESS']:
+                    # report still in progress - short polls first, capped so a ready report isn't left waiting long
+                    # (routine wait, not a retry - so its own sleep/log rather than `exponential_backoff`)
+                    poll_delay = min(.3 * (1.25 ** poll_count), 5) * random.uniform(.95, 1.05)
+                    logging.debug(f"Report status '{status}' for {report_type}, checking again in {poll_delay:.2f}s")
+                    time.sleep(poll_delay)
+                    poll_count += 1
+
                 else:
-                    # added longer timer here because SP-API is sensitive
-                    self.Helpers.exponential_backoff(n=current_attempt, base_seconds=10, rate_of_growth=1.75)
+                    # 'N/A' (status check failed - 403/429/5xx etc.) or unknown status, counts against max_retries
+                    logging.warning(f"Status check failed for {report_type} ('{status}'), attempt {current_attempt}")
+                    self.Helpers.exponential_backoff(
+                        n=current_attempt, base_seconds=2, rate_of_growth=1.75, max_seconds=60
+                    )
                     current_attempt += 1
-                    
+
             except Exception as e:
+                # added longer timer here because SP-API is sensitive
                 logging.error(f"Error on attempt {current_attempt}: {str(e)}")
-                self.Helpers.exponential_backoff(n=current_attempt, base_seconds=10, rate_of_growth=1.75)
+                self.Helpers.exponential_backoff(n=current_attempt, base_seconds=2, rate_of_growth=1.75, max_seconds=60)
                 current_attempt += 1
         
         # break if couldn't populate df after max attempts
         if self.df is None:
-            raise RuntimeError(f"Couldn't fetch orders for range {start_date}-{end_date} after max attempts")
\ No newline at end of file
+            raise RuntimeError(f"Couldn't fetch orders for range {start_date}-{end_date} after max attempts/wait time")
\ No newline at end of file
@@ -1,22 +1,56 @@
+import csv
 import io
 import logging
-import pytz
 import random
 import re
+import threading
 import time
 
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from enum import Enum
+from functools import lru_cache
 from math import ceil
-from typing import List, Tuple, Union
+from types import MappingProxyType
+from typing import Dict, List, Tuple, Union
 
 import openpyxl as xl
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 
 from azure.identity import DefaultAzureCredential
 from azure.storage.blob import BlobServiceClient
 
+# date separators accepted from user input ('/', '.'), normalized to '-' (compiled once, not per call)
+_DATE_SEP_RE = re.compile(r"[/.]")
+_MDY_RE = re.compile(r"(\d{1,2})-(\d{1,2})-(\d{4})", re.ASCII)
+
+# parallel connections per blob upload/download (only kicks in for blobs bigger than the SDK's single-request size)
+_BLOB_MAX_CONCURRENCY = 8
+
+# blob clients (and the credential behind them) are reused across invocations of a warm function worker,
+# keyed by storage account, so the credential chain and TLS setup only happen once per worker
+_BLOB_CREDENTIAL = None
+_BLOB_CLIENTS: Dict[str, BlobServiceClient] = {}
+
+
+@lru_cache(maxsize=2048)
+def _parse_mdy(date_input: str) -> datetime:
+    """Parses a '%m-%d-%Y' str into a datetime - cached, the same few dates get converted over and over"""
+    # fixed format, so match it directly rather than going through strptime (just as strict - 4 digit years only)
+    match = _MDY_RE.fullmatch(date_input)
+    if match is None:
+        raise ValueError(f"time data '{date_input}' does not match format '%m-%d-%Y'")
+    month, day, year = match.groups()
+    return datetime(int(year), int(month), int(day))
+
+
+@lru_cache(maxsize=2048)
+def _format_mdy(date_input: datetime.date) -> str:
+    """Formats a date/datetime as a '%m-%d-%Y' str - cached, see `_parse_mdy`"""
+    return date_input.strftime('%m-%d-%Y')
+
 
 class ZeroSalesError(Exception):
     pass
@@ -75,11 +109,11 @@ class DateRanges:
     
     def date_to_str(self, date_input: datetime.date) -> str:
         """Helper method - converts a date object to (%m-%d-%Y)"""
-        return date_input.strftime("%m-%d-%Y")
+        return _format_mdy(date_input)
     
     def str_to_date(self, date_input: str) -> datetime.date:
-        input_cleaned = re.sub(r"[/.]", "-", date_input)
-        return datetime.strptime(input_cleaned, '%m-%d-%Y')
+        input_cleaned = _DATE_SEP_RE.sub("-", date_input)
+        return _parse_mdy(input_cleaned)
     
     def clean_date_input(self, start_date: str, end_date: str) -> Tuple[str, str]:
         """Cleans user date input, acts as gate, ensures rest of class runs smoothly"""
@@ -87,16 +121,14 @@ class DateRanges:
         if start_date and end_date:
             try:                            
                 # validate start_date
-                start_date_cleaned = re.sub(r"[/.]", "-", start_date)
-                start_date_formatted = datetime.strptime(start_date_cleaned, '%m-%d-%Y')
-                start_date_formatted = pytz.timezone('US/Eastern').localize(start_date_formatted)
+                start_date_cleaned = _DATE_SEP_RE.sub("-", start_date)
+                start_date_formatted = _parse_mdy(start_date_cleaned)
 
                 # validate end_date
-                end_date_cleaned = re.sub(r"[/.]", "-", end_date)
-                end_date_formatted = datetime.strptime(end_date_cleaned, '%m-%d-%Y')
-                end_date_formatted = pytz.timezone('US/Eastern').localize(end_date_formatted)
+                end_date_cleaned = _DATE_SEP_RE.sub("-", end_date)
+                end_date_formatted = _parse_mdy(end_date_cleaned)
 
-                return start_date_formatted.strftime('%m-%d-%Y'), end_date_formatted.strftime('%m-%d-%Y')
+                return _format_mdy(start_date_formatted), _format_mdy(end_date_formatted)
 
             except Exception as e:
                 logging.error(
@@ -127,8 +159,8 @@ class DateRanges:
     
     def date_diff_in_days(self, start_date: str, end_date: str) -> int:
         # convert URI str date params to date objects
-        start_date_dateobj = datetime.strptime(start_date, '%m-%d-%Y')
-        end_date_dateobj = datetime.strptime(end_date, '%m-%d-%Y')
+        start_date_dateobj = _parse_mdy(start_date)
+        end_date_dateobj = _parse_mdy(end_date)
         days_diff = (end_date_dateobj - start_date_dateobj).days
         return days_diff
 
@@ -140,8 +172,7 @@ class DateRanges:
         elif default_to == DateRangeOption.WEEKLY:
             pass  # will add when doing 7D sales automator
         elif default_to == DateRangeOption.PREVIOUS_MONTH:
-            start_date = self.last_months_date_range[0]
-            end_date = self.last_months_date_range[1]
+            start_date, end_date = self.last_months_date_range
         else:
             raise ValueError("Please choose a DateRangeOption of 'DAILY', 'PREVIOUS_MONTH', or 'WEEKLY'")
         
@@ -165,8 +196,8 @@ class DateRanges:
             
         """
         # convert URI str date params to date objects
-        start_date_dateobj = datetime.strptime(start_date, '%m-%d-%Y')
-        end_date_dateobj = datetime.strptime(end_date, '%m-%d-%Y')
+        start_date_dateobj = _parse_mdy(start_date)
+        end_date_dateobj = _parse_mdy(end_date)
         
         # count how many batches of 31 are needed to encapsulate the full date range
         days_diff = (end_date_dateobj - start_date_dateobj).days
@@ -176,34 +207,15 @@ class DateRanges:
         if days_diff <= 31:
             return [(start_date, end_date)]
 
-        # split into 31-day ranges from start to end date   
-        date_ranges = []
-        current_date = start_date_dateobj
-        for n in range(n_batches_of_31):
-            
-            # Amazon reports are inclusive - adding 30 will give 31 days total
-            next_date = current_date + timedelta(31)
-
-            # first range is going to have start_date in first position of the first tuple
-            if n == 0:
-                current_range = (start_date_dateobj, next_date)
-            
-            # last range is going to have end_date in second position of the last tuple  
-            elif n == n_batches_of_31-1:
-                current_range = (current_date, end_date_dateobj)
-            
-            # for everything else, iterate and add 31 each time     
-            else:
-                current_range = (current_date, next_date)
-            
-            # set next date range start
-            current_date = current_date + timedelta(31)
-            
-            # convert current range to str format    
-            current_range_as_str = tuple(date.strftime('%m-%d-%Y') for date in current_range)
-
-            # append to the list
-            date_ranges.append(current_range_as_str)
+        # split into 31-day ranges from start to end date - every range starts where the previous one ended 
+        # (Amazon reports are inclusive - adding 31 each time), the last range ends at the end_date
+        boundaries = [start_date_dateobj + timedelta(31 * n) for n in range(n_batches_of_31)] + [end_date_dateobj]
+        
+        # pair up consecutive boundaries and convert each range to str format
+        date_ranges = [
+            (_format_mdy(range_start), _format_mdy(range_end)) 
+            for range_start, range_end in zip(boundaries, boundaries[1:])
+            ]
             
         return date_ranges            
     
@@ -220,17 +232,22 @@ class Style:
         >>ws = wb.active
         >>styler = Style(ws)  # initiate styler on the specified worksheet
     """
+    _BOLD = xl.styles.Font(bold=True)  # style objects are immutable, safe to share across cells/instances
+
     def __init__(self, ws):
         self.ws = ws
 
-    def change_font_color(self, cell: str, color: str = None) -> None:
-        """Changes the font color of a cell.
+    def change_font_color(self, cell: Union[List[str], str], color: str = None) -> None:
+        """Changes the font color of a cell, or of several cells at once.
         
         Parameters:
-            -cell (str): The cell you wish to change (e.g. 'C2')
+            -cell (Union[List[str], str]): The cell(s) you wish to change (e.g. 'C2', or ['A1', 'B1'])
             -color (str): The 8 digit aRGB hex value color you wish to change to. (e.g. 'FFFFFFFF')
         """
-        self.ws[cell].font = xl.styles.Font(color=color)
+        cells = [cell] if isinstance(cell, str) else cell
+        font = xl.styles.Font(color=color)  # one Font shared by every cell
+        for coordinate in cells:
+            self.ws[coordinate].font = font
         
     def align_and_center(self, start_row: int = 1, padding: int = 5) -> None:
         """ Auto align and widen all columns of your worksheet.
@@ -239,19 +256,18 @@ class Style:
             -start_row: (int) If your headers are long and/or text-wrapped, use >=2 to exclude headers as a reference.
             -padding: (int) Add or remove whitespace from the columns
         """
-        for row in self.ws.iter_cols(min_row=start_row):
-            column_letter = xl.utils.get_column_letter(row[0].column)
+        alignment = xl.styles.Alignment(horizontal='center', vertical='center')  # shared by every cell
+        for column in self.ws.iter_cols(min_row=start_row):
+            column_letter = xl.utils.get_column_letter(column[0].column)
             max_length = 0
-            # first, widen each cell
-            for cell in row:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-                self.ws.column_dimensions[column_letter].width = max_length + padding
-                # then, center align
-                cell.alignment = xl.styles.Alignment(
-                    horizontal='center',
-                    vertical='center'
-                )
+            # center align each cell, while finding the longest value in the column
+            for cell in column:
+                cell.alignment = alignment
+                value_length = len(str(cell.value))
+                if value_length > max_length:
+                    max_length = value_length
+            # then, widen the column once
+            self.ws.column_dimensions[column_letter].width = max_length + padding
 
     def create_table(self, table_name: str = 'Table1') -> None:
         """Formats an Excel array as a table, by identifying the first/last rows and columns of the worksheet.
@@ -259,7 +275,7 @@ class Style:
         Parameters:
             -table_name: (str) The name of the table you are creating (default='Table1')
         """
-        last_column = xl.utils.get_column_letter(len(list(self.ws.columns)))
+        last_column = xl.utils.get_column_letter(self.ws.max_column)  # from the sheet's bookkeeping, no cell scan
         last_row = self.ws.max_row
         table_range = f"A1:{last_column}{last_row}"
 
@@ -279,23 +295,24 @@ class Style:
         create_table.tableStyleInfo = table_design
         self.ws.add_table(create_table)
 
-    def data_bars(self, column: str, color: str = '5e9bdd', start_row: int = 2) -> None:
+    def data_bars(self, column: str, color: str = '5e9bdd', start_row: int = 2, max_value: float = None) -> None:
         """Creates data bars for a value column based on its min/max.
         
         Parameters:
             column: (str) the column LETTER you wish to format with databars
             color: (str) the color of the databars (default=blue)
             start_row: (int) the row number you wish to start the formatting at (default=2)
+            max_value: (float) the top of the data bar scale - pass it if you already know it (e.g. from the source 
+            DataFrame) to skip scanning the column (default=None, scans the column for its max)
         """
         # define the length of the specified column
         column_range = f"{column}{start_row}:{column}{self.ws.max_row}"
         
-        # need to find the max value of the column
-        max_value = 0
-        for cell in self.ws[column][start_row:]:
-            if isinstance(cell.value, (int, float)):
-                if cell.value > max_value:
-                    max_value = cell.value
+        # need to find the max value of the column (numeric cells only, never below 0)
+        if max_value is None:
+            column_values = (cell.value for cell in self.ws[column][start_row:])
+            max_value = max((value for value in column_values if isinstance(value, (int, float))), default=0)
+            max_value = max(max_value, 0)
 
         # create min/max rule
         rule = xl.formatting.rule.DataBarRule(
@@ -330,19 +347,24 @@ class Style:
         if max_row is None:
             max_row = self.ws.max_row
 
+        number_format = '$#,##0.00' if currency else '#,##0'
         for col in columns:
+            column_index = xl.utils.column_index_from_string(col)  # address cells by index, not by 'A1' strings
             for row in range(min_row, max_row + 1):
-                if currency:
-                    self.ws[f"{col}{row}"].number_format = '$#,##0.00'
-                elif not currency:
-                    self.ws[f"{col}{row}"].number_format = '#,##0'
+                self.ws.cell(row=row, column=column_index).number_format = number_format
 
-    def apply_styles_to_cell(self, cell: str, bold: bool = True, highlighter: bool = True, color: str = None) -> None:
+    def apply_styles_to_cell(
+        self, 
+        cell: Union[List[str], str], 
+        bold: bool = True, 
+        highlighter: bool = True, 
+        color: str = None
+    ) -> None:
         """
-        Applies style formatting to a desired cell in the openpyxl worksheet.
+        Applies style formatting to a desired cell (or several cells at once) in the openpyxl worksheet.
 
         Parameters:
-            -cell: (str) The cell you wish to format. (Ex: 'C2')
+            -cell: (Union[List[str], str]) The cell(s) you wish to format. (Ex: 'C2', or ['C2', 'D2'])
             -bold: (bool) If True, the cell will be made bold
             -highlighter: (bool) If True, the cell will be highlighted
             -color: (str) The color to highlight your column. (default=classic yellow)            
@@ -350,10 +372,48 @@ class Style:
         if not color:
             color = 'FFFF00'
 
-        if highlighter:
-            self.ws[cell].fill = xl.styles.PatternFill(start_color=color, end_color=color, fill_type='solid')
-        if bold:
-            self.ws[cell].font = xl.styles.Font(bold=True)
+        cells = [cell] if isinstance(cell, str) else cell
+        fill = xl.styles.PatternFill(start_color=color, end_color=color, fill_type='solid') if highlighter else None
+        for coordinate in cells:
+            if highlighter:
+                self.ws[coordinate].fill = fill
+            if bold:
+                self.ws[coordinate].font = self._BOLD
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket - blocks callers just long enough to keep requests within an API's rate limit
+    
+    Parameters:
+        -rate: (float) tokens restored per second (e.g. .0167 for SP-API createReport, ~1 request per minute)
+        -burst: (int) max tokens that can be banked, i.e. requests allowed back-to-back (e.g. 15 for createReport)
+    
+    Example:
+        >>limiter = RateLimiter(rate=.0167, burst=15)
+        >>limiter.acquire()  # returns right away while the burst lasts, then waits for the bucket to refill
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Takes one token, sleeping until it becomes available (waiting callers queue up in order)"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            
+            # reserve the token now (can go negative), then sleep outside the lock until it has refilled
+            wait_seconds = 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            self._tokens -= 1
+
+        if wait_seconds > 0:
+            logging.info(f"Rate limit reached, waiting {wait_seconds:.1f} seconds before the next request")
+            time.sleep(wait_seconds)
 
 
 class Helpers:
@@ -362,7 +422,7 @@ class Helpers:
         pass
 
     @staticmethod
-    def exponential_backoff(n, rate_of_growth=1.5, base_seconds=2, jitter=.01) -> None:
+    def exponential_backoff(n, rate_of_growth=1.5, base_seconds=2, jitter=.01, max_seconds=None) -> None:
         """Simple timer function to manage API throttling, sleeps for 'n' seconds after being called
         
         Parameters:
@@ -370,13 +430,46 @@ class Helpers:
             -rate_of_growth: (float) multiple by which to increase each iteration (default=1.5x)
             -base_seconds: (float) the starting number of seconds to sleep for (default=2)
             -jitter: (float) offset to avoid exact seconds (default=.01)
+            -max_seconds: (float) upper limit for the sleep, before jitter (default=None, no limit)
         """
         x = (base_seconds * (rate_of_growth ** n))
+        if max_seconds is not None:
+            x = min(x, max_seconds)
         y = (random.uniform(-jitter*x, jitter*x))
         print(f"\tRetry attempt #{n} - {x+y:.2f} seconds ...")
         logging.info(f"\tRetry attempt #{n} - {x+y:.2f} seconds ...")
         time.sleep(x+y)
 
+    @staticmethod
+    def read_delimited(data: bytes, delimiter: str = ',') -> pd.DataFrame:
+        """Parses csv/tsv contents into a Pandas DataFrame with pyarrow's multithreaded reader
+        
+        Parameters:
+            -data: (bytes) The utf-8 encoded file contents, header row first
+            -delimiter: (str) The column separator (default=',')
+            
+        Returns:
+            -(pd.DataFrame) The parsed contents
+            
+        Considerations:
+            -Columns with 'date' in their name are kept as raw str. pyarrow would otherwise infer ISO dates as 
+             timestamps, and the report methods expect str dates (e.g. `purchase-date`.str.split('T'))
+        """
+        # header only - slice rather than split so the payload isn't copied, utf-8-sig drops any BOM (which pyarrow
+        # also strips, so the pinned names still match its column names)
+        line_end = data.find(b'\n')
+        first_line = (data if line_end == -1 else data[:line_end]).rstrip(b'\r').decode('utf-8-sig')
+        header = next(csv.reader([first_line], delimiter=delimiter), [])
+        table = pa_csv.read_csv(
+            io.BytesIO(data),
+            parse_options=pa_csv.ParseOptions(delimiter=delimiter),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={column: pa.string() for column in header if 'date' in column},
+                strings_can_be_null=True
+                )
+            )
+        return table.to_pandas()
+
     @staticmethod
     def save_df_to_mem(df: pd.DataFrame) -> io.BytesIO:
         """Saves a Pandas DataFrame as .xlsx to an in-memory buffer
@@ -386,9 +479,15 @@ class Helpers:
             
         Returns:
             -(io.BytesIO) The Pandas DataFrame saved as io object
+            
+        Considerations:
+            -Writes with xlsxwriter (streams the xml, no openpyxl cell objects)
+            -xlsxwriter's `constant_memory` option is NOT used - pandas writes cells column by column, and 
+             constant_memory silently drops any cell written to a row above the current one
         """
         buffer = io.BytesIO()
-        df.to_excel(buffer, index=False)
+        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
+            df.to_excel(writer, index=False)
         buffer.seek(0)
         return buffer
 
@@ -403,6 +502,7 @@ class BlobHandler:
     
     Considerations:
         -This class uses DefaultAzureCredential(), so make sure your managed identities are in order
+        -The BlobServiceClient is shared by every BlobHandler for the same storage account (within one process)
     """
     def __init__(self, storage_account: str, container_name: str):
         self.storage_account = storage_account
@@ -411,11 +511,19 @@ class BlobHandler:
     
     def __init_blob_client(self) -> BlobServiceClient:
         """Private method: initiates and validates a blob client upon class instantiation. Returns client object"""        
+        global _BLOB_CREDENTIAL
         try:
-            return BlobServiceClient(
-                account_url=f"https://{self.storage_account}.blob.core.windows.net/", 
-                credential=DefaultAzureCredential()
-                )
+            # reuse the client already made for this storage account, if there is one
+            blob_service_client = _BLOB_CLIENTS.get(self.storage_account)
+            if blob_service_client is None:
+                if _BLOB_CREDENTIAL is None:
+                    _BLOB_CREDENTIAL = DefaultAzureCredential()  # caches its tokens, as long as the object is reused
+                blob_service_client = BlobServiceClient(
+                    account_url=f"https://{self.storage_account}.blob.core.windows.net/", 
+                    credential=_BLOB_CREDENTIAL
+                    )
+                _BLOB_CLIENTS[self.storage_account] = blob_service_client
+            return blob_service_client
             
         except Exception as e:
             logging.error(f"Could not validate the BlobServiceClient: {str(e)}")
@@ -437,7 +545,14 @@ class BlobHandler:
                 container=self.container_name, 
                 blob=save_as
                 )
-            blob_client.upload_blob(buffer, overwrite=True)
+            # pass the length up-front, and let the SDK upload large files in parallel blocks
+            buffer.seek(0)
+            blob_client.upload_blob(
+                buffer, 
+                overwrite=True, 
+                length=buffer.getbuffer().nbytes, 
+                max_concurrency=_BLOB_MAX_CONCURRENCY
+                )
             logging.info(f"Uploaded file '{save_as}' to the designated blob container")
 
         except Exception as e:
@@ -452,22 +567,25 @@ class BlobHandler:
 
         Returns:
             -(pd.DataFrame) The blob in Pandas DataFrame format
+            
+        Considerations:
+            -csv/tsv files are parsed with `Helpers.read_delimited` (pyarrow, 'date' columns kept as str)
         """        
         try:
             blob_client = self.blob_service_client.get_blob_client(
                 container=self.container_name, 
                 blob=blob_name
                 )
-            blob_data = blob_client.download_blob().readall()
+            blob_data = blob_client.download_blob(max_concurrency=_BLOB_MAX_CONCURRENCY).readall()
 
             if blob_name.endswith('xlsx'):
                 df = pd.read_excel(io.BytesIO(blob_data), engine='openpyxl')
             elif blob_name.endswith('csv'):
-                df = pd.read_csv(io.BytesIO(blob_data))
+                df = Helpers.read_delimited(blob_data, delimiter=',')
             elif blob_name.endswith('tsv'):
-                df = pd.read_csv(io.BytesIO(blob_data), sep='\t')
+                df = Helpers.read_delimited(blob_data, delimiter='\t')
             elif blob_name.endswith('txt'):
-                txt_file = io.BytesIO(blob_data).read().decode('utf-8')
+                txt_file = blob_data.decode('utf-8')  # decode the downloaded bytes directly, no extra buffer copy
                 df = pd.DataFrame(txt_file.splitlines())
             else:
                 raise TypeError("Method only supports xlsx/csv/tsv/txt files for now, pass only the aforementioned")
@@ -479,7 +597,9 @@ class BlobHandler:
             raise
 
 
-states = {
+# read-only - TaxReports builds its state lookups from this at import time, so it must not change at runtime
+# (to bin more locations, e.g. overseas bases, add them here in the source)
+states = MappingProxyType({
     'AL': 'ALABAMA',
     'AK': 'ALASKA',
     'AZ': 'ARIZONA',
@@ -532,4 +652,4 @@ states = {
     'WI': 'WISCONSIN',
     'WY': 'WYOMING',
     # '_': 'OTHER'
-}
+})
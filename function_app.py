@@ -1,3 +1,4 @@
+import asyncio
 from os import getenv
 
 import azure.functions as func
@@ -7,7 +8,7 @@ from Utilities.TaxReports import TaxRevenueReportGenerator
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 
 @app.route(route="http_trigger")
-def http_trigger(req: func.HttpRequest) -> func.HttpResponse:
+async def http_trigger(req: func.HttpRequest) -> func.HttpResponse:
     """
     Generates tax/revenue report by U.S. state via the `TaxRevenueReportGenerator` class
 
@@ -23,17 +24,27 @@ def http_trigger(req: func.HttpRequest) -> func.HttpResponse:
     Considerations:
         -Review `Utils.report_tools.GenerateFBAReport` docstring for full list of run requirements 
          TODO: move the docstring somewhere more accessible
+        -The report work is blocking (SP-API polling, blob upload), so it runs in a worker thread - keeps the event 
+         loop free to take other invocations in the meantime
     """   
-    # unpack query params 
-    start_date = req.params.get('start_date', None)  # optional
-    end_date = req.params.get('end_date', None)  # optional
-    account_name = req.params.get('account_name')  # required
+    # unpack query params (read the parsed query string once)
+    params = req.params
+    start_date = params.get('start_date', None)  # optional
+    end_date = params.get('end_date', None)  # optional
+    account_name = params.get('account_name')  # required
     if not account_name:
         return func.HttpResponse("Missing 'account_name' parameter in the URI", status_code=400)
 
     # generate report (no retries/error-handling here - everything is happening under the hood, inside the class)
-    report_generator = TaxRevenueReportGenerator(account_name=account_name, start_date=start_date, end_date=end_date)
-    report_generator.generate_tax_report(
+    # (instantiating is blocking too - it fetches the keys and access token)
+    report_generator = await asyncio.to_thread(
+        TaxRevenueReportGenerator, 
+        account_name=account_name, 
+        start_date=start_date, 
+        end_date=end_date
+        )
+    await asyncio.to_thread(
+        report_generator.generate_tax_report,
         storage_account=getenv('STORAGE_ACCOUNT_NAME'), 
         container_name=getenv('TAX_REPORTS_BLOB_CONTAINER_NAME'),
         max_retries=10